@@ -1,4 +1,8 @@
+import contextlib
+import cProfile
+import io
 import os
+import pstats
 import re
 import time
 from datetime import datetime, timedelta
@@ -14,6 +18,21 @@ from gspread_dataframe import set_with_dataframe
 SERVICE_ACCOUNT = os.environ.get("SERVICE_ACCOUNT")
 ACCESS_TOKEN = os.environ.get("ACCESS_TOKEN")
 
+# Set PROFILE to 1, true or yes to write cProfile stats for each guide in a run
+PROFILE = os.environ.get("PROFILE", "").strip().lower() in ("1", "true", "yes")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+# A bad PROFILE_TOP_N shouldn't take down a run, so fall back to 20
+try:
+    PROFILE_TOP_N = int(os.environ.get("PROFILE_TOP_N", 20))
+except ValueError:
+    PROFILE_TOP_N = 20
+
+# Every profile from the same run goes into one folder named after when the run started
+PROFILE_RUN_DIR = os.path.join(
+    PROFILE_DIR, datetime.now(pytz.utc).strftime("%Y-%m-%d_%H-%M-%S")
+)
+
 # Create a temporary json file based on the SERVICE_ACCOUNT env variable
 with open("service_account.json", "w") as f:
     f.write(SERVICE_ACCOUNT)
@@ -64,6 +83,61 @@ def api_call_handler(func):
     raise SystemError
 
 
+def profile_slug(name):
+    """
+    This function turns a guide or worksheet name into something that's safe to use as a file name.
+    """
+    # Guide names come from get_all_records, which turns numeric cells into ints
+    return re.sub(r"[^a-z0-9]+", "-", str(name).lower()).strip("-")
+
+
+def save_profile(profiler, file_name, name):
+    """
+    This function writes the profiler's stats to the run's profile folder and prints the top hotspots.
+    """
+    os.makedirs(PROFILE_RUN_DIR, exist_ok=True)
+
+    # The .prof file can be opened with snakeviz or turned into a flamegraph with flameprof
+    profiler.dump_stats(os.path.join(PROFILE_RUN_DIR, f"{file_name}.prof"))
+
+    # Cumulative time shows which steps are slow, but it's dominated by network calls and retry sleeps.
+    # Internal time shows where the parsing and merging work (BeautifulSoup, find, re.compile, concat) actually goes.
+    summary = io.StringIO()
+    for sort_key in ["cumulative", "tottime"]:
+        summary.write(f"Top {PROFILE_TOP_N} by {sort_key}:\n")
+        pstats.Stats(profiler, stream=summary).sort_stats(sort_key).print_stats(
+            PROFILE_TOP_N
+        )
+
+    with open(os.path.join(PROFILE_RUN_DIR, f"{file_name}.txt"), "w") as f:
+        f.write(summary.getvalue())
+
+    print(f"🔥 Hotspots for {name}:")
+    print(summary.getvalue())
+
+
+@contextlib.contextmanager
+def profiled(file_name, name):
+    """
+    This context manager profiles the code inside it if profiling is turned on. The profile is saved even if that code fails.
+    """
+    if not PROFILE:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        # Profiling should never be the reason a run fails
+        try:
+            save_profile(profiler, file_name, name)
+        except Exception as e:
+            print(f"🤦‍♂️ Couldn't save the profile for {name}: {e}")
+
+
 def process_market_directory(url, directory, db, timezone, metadata):
     """
     This function processes the market directory and updates the market database. It's the main function. It calls all the other necessary functions.
@@ -85,40 +159,51 @@ def process_market_directory(url, directory, db, timezone, metadata):
     # Loop through each GUIDE in the market_directory_df
     for index, row in market_directory_df.iterrows():
         print(f'🥡 Working on {row["Guide name"]}...')
-        # Open the guide spreadsheet and store the worksheets and dataframes
-        (
-            restaurant_listings_df,
-            restaurant_nav_df,
-            story_settings_df,
-        ) = open_guide_spreadsheet(row["C2P Sheet URL"], row["Guide name"])
-
-        live_page_df = scrape_live_guide(
-            row["Live URL"], row["Guide name"], row["C2P Sheet URL"]
-        )
-
-        # Dedupe the restaurant_nav_df
-        restaurant_nav_df = restaurant_nav_df.drop_duplicates(subset=["Listing_Id"])
-
-        # Join the restaurant_nav_df to the live_page_df on the "Listing_Id" column. From the restaurant_nav_df, I only want the Lat and Lng columns.
-        live_page_df = live_page_df.join(
-            restaurant_nav_df[["Listing_Id", "Lat", "Lng"]].set_index("Listing_Id"),
-            on="Listing_Id",
-        )
 
-        # Concateenate the live_page_df to the updated_market_database_df
-        updated_market_database_df = pd.concat(
-            [updated_market_database_df, live_page_df]
+        # Prefix with the row index so every guide gets its own profile, even if two names slug the same
+        profile_name = f'{index:03d}-{profile_slug(row["Guide name"]) or "guide"}'
+
+        with profiled(profile_name, row["Guide name"]):
+            # Open the guide spreadsheet and store the worksheets and dataframes
+            (
+                restaurant_listings_df,
+                restaurant_nav_df,
+                story_settings_df,
+            ) = open_guide_spreadsheet(row["C2P Sheet URL"], row["Guide name"])
+
+            live_page_df = scrape_live_guide(
+                row["Live URL"], row["Guide name"], row["C2P Sheet URL"]
+            )
+
+            # Dedupe the restaurant_nav_df
+            restaurant_nav_df = restaurant_nav_df.drop_duplicates(
+                subset=["Listing_Id"]
+            )
+
+            # Join the restaurant_nav_df to the live_page_df on the "Listing_Id" column. From the restaurant_nav_df, I only want the Lat and Lng columns.
+            live_page_df = live_page_df.join(
+                restaurant_nav_df[["Listing_Id", "Lat", "Lng"]].set_index(
+                    "Listing_Id"
+                ),
+                on="Listing_Id",
+            )
+
+            # Concateenate the live_page_df to the updated_market_database_df
+            updated_market_database_df = pd.concat(
+                [updated_market_database_df, live_page_df]
+            )
+
+    # The leading underscore keeps this from ever colliding with a guide's profile
+    with profiled(f"_write-{profile_slug(db) or 'db'}", db):
+        # Sort the updated_market_database_df by the Display_Name column
+        updated_market_database_df = updated_market_database_df.sort_values(
+            by=["Display_Name"]
         )
 
-    # Sort the updated_market_database_df by the Display_Name column
-    updated_market_database_df = updated_market_database_df.sort_values(
-        by=["Display_Name"]
-    )
-
-    # Clear the market_database_ws
-    market_database_ws.clear()
+        # Clear the market_database_ws
+        market_database_ws.clear()
 
-    set_with_dataframe(market_database_ws, updated_market_database_df)
+        set_with_dataframe(market_database_ws, updated_market_database_df)
 
     # Get the current time and date
     date, time, next_run = create_time_stamp(timezone)